@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-from io import BytesIO
 from typing import TYPE_CHECKING, BinaryIO
 
 from packaging.version import parse
@@ -50,7 +49,7 @@ def check_minimal_arrow_version() -> None:
         )
 
 
-def dump_shards(shards: list[bytes], file: BinaryIO) -> None:
+def dump_shards(shards: list[bytes] | list[bytearray], file: BinaryIO) -> None:
     """
     Write multiple shard tables to the file
 
@@ -86,22 +85,29 @@ def load_partition(file: BinaryIO) -> list[bytes]:
 
 
 def convert_partition(data: bytes) -> pa.Table:
+    """Read all streams of a partition file into a single table
+
+    The resulting table references ``data`` instead of copying it.
+    """
     import pyarrow as pa
 
-    file = BytesIO(data)
-    end = len(data)
+    buffer = pa.py_buffer(data)
+    file = pa.BufferReader(buffer)
     shards = []
-    while file.tell() < end:
-        sr = pa.RecordBatchStreamReader(file)
+    while file.tell() < buffer.size:
+        sr = pa.ipc.open_stream(file)
         shards.append(sr.read_all())
     return pa.concat_tables(shards)
 
 
-def list_of_buffers_to_table(data: list[bytes]) -> pa.Table:
-    """Convert a list of arrow buffers and a schema to an Arrow Table"""
+def list_of_buffers_to_table(data: list[bytes] | list[memoryview]) -> pa.Table:
+    """Convert a list of arrow buffers and a schema to an Arrow Table
+
+    The buffers are not copied, the resulting table keeps references to them.
+    """
     import pyarrow as pa
 
-    return pa.concat_tables(deserialize_table(buffer) for buffer in data)
+    return pa.concat_tables([deserialize_table(buffer) for buffer in data])
 
 
 def deserialize_schema(data: bytes) -> pa.Schema:
@@ -129,18 +135,38 @@ def deserialize_schema(data: bytes) -> pa.Schema:
     return table.schema
 
 
-def serialize_table(table: pa.Table) -> bytes:
-    import io
+def serialize_table(table: pa.Table) -> bytearray:
+    """Serialize a table into an arrow stream
 
+    The stream is written straight into a preallocated ``bytearray`` instead of
+    being copied out of a growing buffer.
+    """
     import pyarrow as pa
 
-    stream = io.BytesIO()
-    with pa.ipc.new_stream(stream, table.schema) as writer:
+    mock = pa.MockOutputStream()
+    with pa.ipc.new_stream(mock, table.schema) as writer:
         writer.write_table(table)
-    return stream.getvalue()
+    out = bytearray(mock.size())
+    with pa.ipc.new_stream(
+        pa.FixedSizeBufferWriter(pa.py_buffer(out)), table.schema
+    ) as writer:
+        writer.write_table(table)
+    return out
+
+
+def serialize_tables(tables: list[pa.Table]) -> bytearray:
+    """Serialize tables of the same schema into a single stream
+
+    See Also
+    --------
+    serialize_table
+    """
+    import pyarrow as pa
+
+    return serialize_table(pa.concat_tables(tables))
 
 
-def deserialize_table(buffer: bytes) -> pa.Table:
+def deserialize_table(buffer: bytes | memoryview) -> pa.Table:
     import pyarrow as pa
 
     with pa.ipc.open_stream(pa.py_buffer(buffer)) as reader:
@@ -3,11 +3,12 @@ from __future__ import annotations
 import asyncio
 import contextlib
 import logging
+import threading
 from collections import defaultdict
-from collections.abc import Iterator
+from collections.abc import Callable, Iterator
 from typing import Any, Generic, Sized, TypeVar
 
-from distributed.metrics import time
+from distributed.metrics import monotonic, time
 from distributed.shuffle._limiter import ResourceLimiter
 from distributed.sizeof import sizeof
 
@@ -35,6 +36,15 @@ class ShardsBuffer(Generic[ShardType]):
 
     If exceptions occur during writing, the buffer is automatically closed. Subsequent attempts to write will raise the same exception.
     Flushing will not raise an exception. To ensure that the buffer finished successfully, please call `ShardsBuffer.raise_on_exception`
+
+    The memory footprint of a shard is measured with ``sizeof``, which defaults
+    to ``distributed.sizeof.sizeof``.
+
+    If ``min_message_size`` is set, shards are held back until a bucket has
+    accumulated at least that many bytes so that they can be processed in one
+    go. Smaller buckets are still processed once the buffer is flushed, the
+    memory limiter is exhausted, or when ``max_linger`` seconds have passed
+    since the bucket was first written to.
     """
 
     shards: defaultdict[str, list[ShardType]]
@@ -43,6 +53,8 @@ class ShardsBuffer(Generic[ShardType]):
     memory_limiter: ResourceLimiter | None
     diagnostics: dict[str, float]
     max_message_size: int
+    min_message_size: int
+    max_linger: float
 
     bytes_total: int
     bytes_memory: int
@@ -55,12 +67,17 @@ class ShardsBuffer(Generic[ShardType]):
     _tasks: list[asyncio.Task]
     _shards_available: asyncio.Condition
     _flush_lock: asyncio.Lock
+    _diagnostics_lock: threading.Lock
+    _first_written: dict[str, float]
 
     def __init__(
         self,
         memory_limiter: ResourceLimiter | None,
         concurrency_limit: int = 2,
         max_message_size: int = -1,
+        min_message_size: int = 0,
+        max_linger: float = 1.0,
+        sizeof: Callable[[ShardType], int] = sizeof,
     ) -> None:
         self._accepts_input = True
         self.shards = defaultdict(list)
@@ -76,7 +93,14 @@ class ShardsBuffer(Generic[ShardType]):
         ]
         self._shards_available = asyncio.Condition()
         self._flush_lock = asyncio.Lock()
+        # Reads may happen in a thread, guard the counters they update
+        self._diagnostics_lock = threading.Lock()
         self.max_message_size = max_message_size
+        self.min_message_size = min_message_size
+        self.max_linger = max_linger
+        self.sizeof = sizeof
+        # When a bucket was first written to, oldest first
+        self._first_written = {}
 
         self.bytes_total = 0
         self.bytes_memory = 0
@@ -127,16 +151,53 @@ class ShardsBuffer(Generic[ShardType]):
     def empty(self) -> bool:
         return not self.shards
 
-    async def _background_task(self) -> None:
-        def _continue() -> bool:
-            return bool(self.shards or self._inputs_done)
+    def _next_bucket(self) -> str | None:
+        """Pick the bucket to process next or None if all should be held back"""
+        if not self.shards:
+            return None
+        largest = max(self.sizes, key=self.sizes.__getitem__)
+        if (
+            self._inputs_done
+            or not self._accepts_input
+            or self.min_message_size <= 0
+            or self.sizes[largest] >= self.min_message_size
+            or (self.memory_limiter and not self.memory_limiter.available())
+        ):
+            return largest
+        # Other buffers may hold the memory limiter, don't hold back small
+        # buckets forever
+        oldest, first_written = next(iter(self._first_written.items()))
+        if first_written + self.max_linger <= monotonic():
+            return oldest
+        return None
+
+    async def _wait_for_bucket(self) -> str | None:
+        """Wait until a bucket should be processed
+
+        Returns None once all inputs are done and nothing is left. This must be
+        called while holding ``_shards_available``.
+        """
+        while True:
+            if self._inputs_done and not self.shards:
+                return None
+            part_id = self._next_bucket()
+            if part_id is not None:
+                return part_id
+            if not self.shards:
+                await self._shards_available.wait()
+                continue
+            deadline = next(iter(self._first_written.values())) + self.max_linger
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    self._shards_available.wait(), deadline - monotonic()
+                )
 
+    async def _background_task(self) -> None:
         while True:
             async with self._shards_available:
-                await self._shards_available.wait_for(_continue)
-                if self._inputs_done and not self.shards:
+                part_id = await self._wait_for_bucket()
+                if part_id is None:
                     break
-                part_id = max(self.sizes, key=self.sizes.__getitem__)
                 if self.max_message_size > 0:
                     size = 0
                     shards = []
@@ -144,7 +205,7 @@ class ShardsBuffer(Generic[ShardType]):
                         try:
                             shard = self.shards[part_id].pop()
                             shards.append(shard)
-                            s = sizeof(shard)
+                            s = self.sizeof(shard)
                             size += s
                             self.sizes[part_id] -= s
                         except IndexError:
@@ -154,9 +215,11 @@ class ShardsBuffer(Generic[ShardType]):
                                 del self.shards[part_id]
                                 assert not self.sizes[part_id]
                                 del self.sizes[part_id]
+                                self._first_written.pop(part_id, None)
                 else:
                     shards = self.shards.pop(part_id)
                     size = self.sizes.pop(part_id)
+                    del self._first_written[part_id]
                 self._shards_available.notify_all()
             await self.process(part_id, shards, size)
 
@@ -184,7 +247,7 @@ class ShardsBuffer(Generic[ShardType]):
 
         sizes = {}
         for id_, shards in data.items():
-            size = sum(map(sizeof, shards))
+            size = sum(map(self.sizeof, shards))
             sizes[id_] = size
         total_batch_size = sum(sizes.values())
         self.bytes_memory += total_batch_size
@@ -192,10 +255,12 @@ class ShardsBuffer(Generic[ShardType]):
 
         if self.memory_limiter:
             self.memory_limiter.increase(total_batch_size)
+        now = monotonic()
         async with self._shards_available:
             for id_, shards in data.items():
                 self.shards[id_].extend(shards)
                 self.sizes[id_] += sizes[id_]
+                self._first_written.setdefault(id_, now)
             self._shards_available.notify()
         if self.memory_limiter:
             await self.memory_limiter.wait_for_available()
@@ -239,6 +304,7 @@ class ShardsBuffer(Generic[ShardType]):
         self._accepts_input = False
         self._inputs_done = True
         self.shards.clear()
+        self._first_written.clear()
         self.bytes_memory = 0
         async with self._shards_available:
             self._shards_available.notify_all()
@@ -255,4 +321,5 @@ class ShardsBuffer(Generic[ShardType]):
         start = time()
         yield
         stop = time()
-        self.diagnostics[name] += stop - start
+        with self._diagnostics_lock:
+            self.diagnostics[name] += stop - start
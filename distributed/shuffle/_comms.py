@@ -1,11 +1,12 @@
 from __future__ import annotations
 
-from typing import Awaitable, Callable
+from typing import Any, Awaitable, Callable
 
 from dask.utils import parse_bytes
 
 from distributed.shuffle._disk import ShardsBuffer
 from distributed.shuffle._limiter import ResourceLimiter
+from distributed.sizeof import sizeof
 from distributed.utils import log_errors
 
 
@@ -36,6 +37,12 @@ class CommShardsBuffer(ShardsBuffer):
         The maximum number of connections to have out at once
     max_message_size: str
         The maximum size of a single message that we want to send
+    min_message_size: str
+        Shards for a worker are collected until a message of at least this size
+        can be sent, unless the buffer is flushed or they were held back for
+        longer than ``max_linger``
+    max_linger: float
+        How many seconds shards may be held back before they are sent anyway
 
     Parameters
     ----------
@@ -43,25 +50,34 @@ class CommShardsBuffer(ShardsBuffer):
         How to send a list of shards to a worker
         Expects an address of the target worker (string)
         and a payload of shards (list of bytes) to send to that worker
+    sizeof: callable
+        How to measure the size of a single shard
     """
 
     max_message_size = parse_bytes("2 MiB")
+    min_message_size = parse_bytes("1 MiB")
+    # Keep this short, receivers can't make progress on data that is held back
+    max_linger = 0.1
     memory_limit = parse_bytes("100 MiB")
 
     def __init__(
         self,
-        send: Callable[[str, list[tuple[int, bytes]]], Awaitable[None]],
+        send: Callable[[str, list[Any]], Awaitable[None]],
         memory_limiter: ResourceLimiter | None = None,
         concurrency_limit: int = 10,
+        sizeof: Callable[[Any], int] = sizeof,
     ):
         super().__init__(
             memory_limiter=memory_limiter,
             concurrency_limit=concurrency_limit,
             max_message_size=CommShardsBuffer.max_message_size,
+            min_message_size=CommShardsBuffer.min_message_size,
+            max_linger=CommShardsBuffer.max_linger,
+            sizeof=sizeof,
         )
         self.send = send
 
-    async def _process(self, address: str, shards: list[tuple[int, bytes]]) -> None:
+    async def _process(self, address: str, shards: list[Any]) -> None:
         """Send one message off to a neighboring worker"""
         with log_errors():
             # Consider boosting total_size a bit here to account for duplication
@@ -42,6 +42,9 @@ class DiskShardsBuffer(ShardsBuffer):
         Reads an object from that file, like pickle.load
     sizeof: callable
         Measures the size of an object in memory
+    min_message_size: int
+        Hold back shards until at least this many bytes of a bucket can be
+        written at once. This avoids lots of tiny appends to the same file.
     """
 
     concurrency_limit = 2
@@ -52,11 +55,13 @@ class DiskShardsBuffer(ShardsBuffer):
         dump: Callable[[list[ShardType], BinaryIO], None],
         load: Callable[[BinaryIO], list[ShardType]],
         memory_limiter: ResourceLimiter | None = None,
+        min_message_size: int = 0,
     ):
         super().__init__(
             memory_limiter=memory_limiter,
             # Disk is not able to run concurrently atm
             concurrency_limit=1,
+            min_message_size=min_message_size,
         )
         self.directory = pathlib.Path(directory)
         self.directory.mkdir(exist_ok=True)
@@ -86,7 +91,10 @@ class DiskShardsBuffer(ShardsBuffer):
                     self.dump(shards, f)
 
     def read(self, id: int | str) -> list[ShardType]:
-        """Read a complete file back into memory"""
+        """Read a complete file back into memory
+
+        This is safe to call from a thread.
+        """
         self.raise_on_exception()
         if not self._inputs_done:
             raise RuntimeError("Tried to read from file before done.")
@@ -104,7 +112,8 @@ class DiskShardsBuffer(ShardsBuffer):
 
         # TODO: We could consider deleting the file at this point
         if parts:
-            self.bytes_read += size
+            with self._diagnostics_lock:
+                self.bytes_read += size
             return parts
         else:
             raise KeyError(id)
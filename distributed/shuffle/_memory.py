@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Any, Callable, Generic
+
+from distributed.shuffle._buffer import ShardType
+from distributed.shuffle._limiter import ResourceLimiter
+from distributed.sizeof import sizeof
+
+
+class MemoryShardsBuffer(Generic[ShardType]):
+    """Keep shards in memory for as long as they fit
+
+    This sits in front of a ``DiskShardsBuffer`` and holds on to received
+    shards so that they don't have to make a round trip to disk if the output
+    fits into memory. Once the memory limit is reached, the partitions that
+    were written first are handed back to be spilled to disk.
+
+    Unlike the other buffers this never blocks. Writes always succeed and
+    return whatever has to be spilled. Like reading from disk, reading a
+    partition does not remove it, the shards are only dropped on ``close``.
+
+    **State**
+
+    -   shards: dict[str, list[ShardType]]
+
+        The shards held in memory, in the order in which their partitions were
+        first written
+
+    -   sizes: dict[str, int]
+
+        The size of each list of shards
+
+    Parameters
+    ----------
+    memory_limiter: ResourceLimiter
+        Limits the total amount of memory held across all memory buffers
+    sizeof: callable
+        How to measure the size of a single shard
+    """
+
+    shards: dict[str, list[ShardType]]
+    sizes: defaultdict[str, int]
+    memory_limiter: ResourceLimiter | None
+
+    bytes_memory: int
+    bytes_spilled: int
+    bytes_read: int
+
+    def __init__(
+        self,
+        memory_limiter: ResourceLimiter | None,
+        sizeof: Callable[[ShardType], int] = sizeof,
+    ) -> None:
+        self.shards = {}
+        self.sizes = defaultdict(int)
+        self.memory_limiter = memory_limiter
+        self.sizeof = sizeof
+
+        self.bytes_memory = 0
+        self.bytes_spilled = 0
+        self.bytes_read = 0
+
+    def heartbeat(self) -> dict[str, Any]:
+        return {
+            "memory": self.bytes_memory,
+            "buckets": len(self.shards),
+            "spilled": self.bytes_spilled,
+            "read": self.bytes_read,
+        }
+
+    async def write(
+        self, data: dict[str, list[ShardType]]
+    ) -> dict[str, list[ShardType]]:
+        """Keep data in memory and return the partitions that should be spilled
+
+        Parameters
+        ----------
+        data: dict
+            A dictionary mapping partitions to lists of shards
+        """
+        for id_, shards in data.items():
+            id_ = str(id_)
+            size = sum(map(self.sizeof, shards))
+            self.shards.setdefault(id_, []).extend(shards)
+            self.sizes[id_] += size
+            self.bytes_memory += size
+            if self.memory_limiter:
+                self.memory_limiter.increase(size)
+
+        spill = {}
+        while self.shards and (
+            self.memory_limiter is not None and not self.memory_limiter.available()
+        ):
+            id_ = next(iter(self.shards))
+            spill[id_] = self.shards.pop(id_)
+            size = self.sizes.pop(id_)
+            self.bytes_spilled += size
+            await self._release(size)
+        return spill
+
+    def read(self, id: int | str) -> list[ShardType]:
+        """Return all shards of a partition
+
+        Returns an empty list if nothing of this partition is held in memory
+        """
+        id = str(id)
+        self.bytes_read += self.sizes.get(id, 0)
+        return list(self.shards.get(id, ()))
+
+    async def _release(self, size: int) -> None:
+        self.bytes_memory -= size
+        if self.memory_limiter:
+            await self.memory_limiter.decrease(size)
+
+    async def close(self) -> None:
+        """Drop everything held in memory"""
+        self.shards.clear()
+        self.sizes.clear()
+        await self._release(self.bytes_memory)
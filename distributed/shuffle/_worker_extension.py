@@ -7,11 +7,9 @@ import os
 import time
 from collections import defaultdict
 from collections.abc import Callable, Iterator
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import TYPE_CHECKING, Any, TypeVar, overload
 
-import toolz
-
 from dask.utils import parse_bytes
 
 from distributed.core import PooledRPCCall
@@ -22,16 +20,17 @@ from distributed.shuffle._arrow import (
     dump_shards,
     list_of_buffers_to_table,
     load_partition,
-    serialize_table,
+    serialize_tables,
 )
 from distributed.shuffle._comms import CommShardsBuffer
 from distributed.shuffle._disk import DiskShardsBuffer
 from distributed.shuffle._limiter import ResourceLimiter
+from distributed.shuffle._memory import MemoryShardsBuffer
 from distributed.shuffle._shuffle import ShuffleId
-from distributed.sizeof import sizeof
 from distributed.utils import log_errors, sync
 
 if TYPE_CHECKING:
+    import numpy as np
     import pandas as pd
     import pyarrow as pa
 
@@ -76,8 +75,9 @@ class ShuffleRun:
         The local address this Shuffle can be contacted by using `rpc`.
     directory:
         The scratch directory to buffer data in.
-    nthreads:
-        How many background threads to use for compute.
+    executor:
+        The thread pool to offload compute to. This is shared by all shuffles
+        on a worker.
     loop:
         The event loop.
     rpc:
@@ -89,8 +89,44 @@ class ShuffleRun:
     memory_limiter_comm:
         A ``ResourceLimiter`` limiting the total amount of memory used in either
         buffer.
+    memory_limiter_output:
+        A ``ResourceLimiter`` limiting the total amount of received data that is
+        kept in memory instead of being written to disk.
     """
 
+    scheduler: PooledRPCCall
+    rpc: Callable[[str], PooledRPCCall]
+    column: str
+    id: ShuffleId
+    run_id: int
+    schema: pa.Schema
+    output_workers: set
+    executor: ThreadPoolExecutor
+    local_address: str
+    partitions_of: dict[str, list[int]]
+    worker_for: pd.Series
+    _worker_categories: np.ndarray
+    _worker_lookup: np.ndarray
+    closed: bool
+    _memory_buffer: MemoryShardsBuffer
+    _disk_buffer: DiskShardsBuffer
+    _comm_buffer: CommShardsBuffer
+    diagnostics: dict[str, float]
+    transferred: bool
+    received: bytearray
+    total_recvd: int
+    start_time: float
+    _exception: Exception | None
+    _closed_event: asyncio.Event
+    _offloaded: set[Future]
+
+    # Many of these are accessed in the hot loops of sending and receiving
+    __slots__ = tuple(__annotations__)
+
+    #: Shards of an output partition are collected until at least this many
+    #: bytes can be appended to its file at once
+    min_disk_write_size = parse_bytes("4 MiB")
+
     def __init__(
         self,
         worker_for: dict[int, str],
@@ -101,11 +137,12 @@ class ShuffleRun:
         run_id: int,
         local_address: str,
         directory: str,
-        nthreads: int,
+        executor: ThreadPoolExecutor,
         rpc: Callable[[str], PooledRPCCall],
         scheduler: PooledRPCCall,
         memory_limiter_disk: ResourceLimiter,
         memory_limiter_comms: ResourceLimiter,
+        memory_limiter_output: ResourceLimiter,
     ):
         import pandas as pd
 
@@ -116,35 +153,55 @@ class ShuffleRun:
         self.run_id = run_id
         self.schema = schema
         self.output_workers = output_workers
-        self.executor = ThreadPoolExecutor(nthreads)
-        partitions_of = defaultdict(list)
+        self.executor = executor
         self.local_address = local_address
-        for part, addr in worker_for.items():
-            partitions_of[addr].append(part)
-        self.partitions_of = dict(partitions_of)
         self.worker_for = pd.Series(worker_for, name="_workers").astype("category")
+        self.partitions_of = {
+            addr: parts.tolist()
+            for addr, parts in self.worker_for.groupby(
+                self.worker_for, observed=True
+            ).groups.items()
+        }
+        self._worker_categories = self.worker_for.cat.categories.to_numpy()
+        # worker_for doesn't change for the lifetime of the run, build the
+        # lookup for split_by_worker once instead of for every input partition
+        self._worker_lookup = _worker_codes_lookup(self.worker_for)
         self.closed = False
 
+        self._memory_buffer = MemoryShardsBuffer(
+            memory_limiter=memory_limiter_output,
+            # Tables are zero-copy slices of the received data, sizeof would
+            # count the full underlying buffers for each of them
+            sizeof=lambda table: table.nbytes,
+        )
         self._disk_buffer = DiskShardsBuffer(
             dump=dump_shards,
             load=load_partition,
             directory=directory,
             memory_limiter=memory_limiter_disk,
+            min_message_size=self.min_disk_write_size,
         )
 
         self._comm_buffer = CommShardsBuffer(
-            send=self.send, memory_limiter=memory_limiter_comms
+            send=self.send,
+            memory_limiter=memory_limiter_comms,
+            # Shards are zero-copy slices of a larger table, sizeof would count
+            # the full underlying buffers for each of them
+            sizeof=lambda shard: shard[1].nbytes,
         )
         # TODO: reduce number of connections to number of workers
         # MultiComm.max_connections = min(10, n_workers)
 
-        self.diagnostics: dict[str, float] = defaultdict(float)
+        self.diagnostics = defaultdict(float)
         self.transferred = False
-        self.received: set[int] = set()
+        # Input partitions are dense integers, keep one flag per partition
+        # instead of a set of ints. This grows as higher ids come in.
+        self.received = bytearray()
         self.total_recvd = 0
         self.start_time = time.time()
-        self._exception: Exception | None = None
+        self._exception = None
         self._closed_event = asyncio.Event()
+        self._offloaded = set()
 
     def __repr__(self) -> str:
         return f"<Shuffle {self.id}[{self.run_id}] on {self.local_address}>"
@@ -154,10 +211,10 @@ class ShuffleRun:
 
     @contextlib.contextmanager
     def time(self, name: str) -> Iterator[None]:
-        start = time.time()
+        start = time.perf_counter_ns()
         yield
-        stop = time.time()
-        self.diagnostics[name] += stop - start
+        stop = time.perf_counter_ns()
+        self.diagnostics[name] += (stop - start) / 1e9
 
     async def barrier(self) -> None:
         self.raise_if_closed()
@@ -165,10 +222,19 @@ class ShuffleRun:
         # up the comm pool on scheduler side
         await self.scheduler.shuffle_barrier(id=self.id, run_id=self.run_id)
 
-    async def send(self, address: str, shards: list[tuple[int, bytes]]) -> None:
+    async def send(self, address: str, shards: list[tuple[int, pa.Table]]) -> None:
         self.raise_if_closed()
+        # Coalesce all buffered shards for this worker into a single IPC stream
+        # and remember which rows belong to which input partition
+        input_partitions = [
+            (input_partition, len(table)) for input_partition, table in shards
+        ]
+        buffer = await self.offload(serialize_tables, [table for _, table in shards])
+        del shards
+        # Only wrap the buffer so that it is sent as a frame of its own instead
+        # of being pickled together with the input partitions
         return await self.rpc(address).shuffle_receive(
-            data=to_serialize(shards),
+            data=[(input_partitions, to_serialize(memoryview(buffer)))],
             shuffle_id=self.id,
             run_id=self.run_id,
         )
@@ -176,55 +242,91 @@ class ShuffleRun:
     async def offload(self, func: Callable[..., T], *args: Any) -> T:
         self.raise_if_closed()
         with self.time("cpu"):
-            return await asyncio.get_running_loop().run_in_executor(
-                self.executor,
-                func,
-                *args,
-            )
+            future = self.executor.submit(func, *args)
+            # The executor is shared, remember what to cancel when closing
+            self._offloaded.add(future)
+            try:
+                return await asyncio.wrap_future(future)
+            finally:
+                self._offloaded.discard(future)
 
     def heartbeat(self) -> dict[str, Any]:
         comm_heartbeat = self._comm_buffer.heartbeat()
         comm_heartbeat["read"] = self.total_recvd
         return {
+            "memory": self._memory_buffer.heartbeat(),
             "disk": self._disk_buffer.heartbeat(),
             "comm": comm_heartbeat,
             "diagnostics": self.diagnostics,
             "start": self.start_time,
         }
 
-    async def receive(self, data: list[tuple[int, bytes]]) -> None:
+    async def receive(
+        self, data: list[tuple[list[tuple[int, int]], memoryview]]
+    ) -> None:
         await self._receive(data)
 
-    async def _receive(self, data: list[tuple[int, bytes]]) -> None:
+    async def _receive(
+        self, data: list[tuple[list[tuple[int, int]], memoryview]]
+    ) -> None:
         self.raise_if_closed()
 
+        # Every buffer holds the shards of one or more input partitions. Rows
+        # of input partitions we've seen before are dropped after deserializing
         filtered = []
-        for d in data:
-            if d[0] not in self.received:
-                filtered.append(d[1])
-                self.received.add(d[0])
-                self.total_recvd += sizeof(d)
+        duplicates = []
+        offset = 0
+        for input_partitions, buffer in data:
+            ranges = []
+            new = False
+            start = offset
+            for input_partition, nrows in input_partitions:
+                if input_partition >= len(self.received):
+                    self.received.extend(
+                        bytes(input_partition + 1 - len(self.received))
+                    )
+                if self.received[input_partition]:
+                    ranges.append((start, nrows))
+                else:
+                    self.received[input_partition] = 1
+                    new = True
+                start += nrows
+            if not new:
+                continue
+            filtered.append(buffer)
+            duplicates.extend(ranges)
+            offset = start
+            self.total_recvd += len(buffer)
         del data
         if not filtered:
             return
         try:
-            groups = await self.offload(self._repartition_buffers, filtered)
+            groups = await self.offload(self._repartition_buffers, filtered, duplicates)
             del filtered
             await self._write_to_disk(groups)
         except Exception as e:
             self._exception = e
             raise
 
-    def _repartition_buffers(self, data: list[bytes]) -> dict[str, list[bytes]]:
+    def _repartition_buffers(
+        self, data: list[memoryview], duplicates: list[tuple[int, int]]
+    ) -> dict[str, list[pa.Table]]:
         table = list_of_buffers_to_table(data)
+        if duplicates:
+            table = _drop_rows(table, duplicates)
         groups = split_by_partition(table, self.column)
-        assert len(table) == sum(map(len, groups.values()))
         del data
-        return {k: [serialize_table(v)] for k, v in groups.items()}
+        return {k: [v] for k, v in groups.items()}
 
-    async def _write_to_disk(self, data: dict[str, list[bytes]]) -> None:
+    async def _write_to_disk(self, data: dict[str, list[pa.Table]]) -> None:
         self.raise_if_closed()
-        await self._disk_buffer.write(data)
+        # Keep as much as possible in memory and only spill the rest to disk
+        spill = await self._memory_buffer.write(data)
+        if spill:
+            # Write all spilled tables of a partition as a single stream
+            serialized = await self.offload(_serialize_partitions, spill)
+            del spill
+            await self._disk_buffer.write(serialized)
 
     def raise_if_closed(self) -> None:
         if self.closed:
@@ -239,20 +341,21 @@ class ShuffleRun:
         if self.transferred:
             raise RuntimeError(f"Cannot add more partitions to shuffle {self}")
 
-        def _() -> dict[str, list[tuple[int, bytes]]]:
+        def _() -> dict[str, list[tuple[int, pa.Table]]]:
             out = split_by_worker(
                 data,
                 self.column,
                 self.worker_for,
+                self._worker_categories,
+                lookup=self._worker_lookup,
             )
-            out = {k: [(input_partition, serialize_table(t))] for k, t in out.items()}
-            return out
+            return {k: [(input_partition, t)] for k, t in out.items()}
 
         out = await self.offload(_)
         await self._write_to_comm(out)
         return self.run_id
 
-    async def _write_to_comm(self, data: dict[str, list[tuple[int, bytes]]]) -> None:
+    async def _write_to_comm(self, data: dict[str, list[tuple[int, pa.Table]]]) -> None:
         self.raise_if_closed()
         await self._comm_buffer.write(data)
 
@@ -268,15 +371,28 @@ class ShuffleRun:
         # data in the case something has gone very wrong
 
         await self.flush_receive()
+        in_memory = self._memory_buffer.read(i)
         try:
-            data = self._read_from_disk(i)
-            df = convert_partition(data)
-            with self.time("cpu"):
-                out = df.to_pandas()
+            out = await self.offload(self._load_output_partition, i, in_memory)
         except KeyError:
             out = self.schema.empty_table().to_pandas()
         return out
 
+    def _load_output_partition(self, i: int, in_memory: list[pa.Table]) -> pd.DataFrame:
+        import pyarrow as pa
+
+        tables = list(in_memory)
+        del in_memory
+        try:
+            tables.append(convert_partition(self._read_from_disk(i)))
+        except KeyError:
+            # The partition may have been kept in memory entirely
+            if not tables:
+                raise
+        df = pa.concat_tables(tables)
+        del tables
+        return df.to_pandas()
+
     def _read_from_disk(self, id: int | str) -> bytes:
         self.raise_if_closed()
         data: list[bytes] = self._disk_buffer.read(id)
@@ -308,12 +424,13 @@ class ShuffleRun:
             return
 
         self.closed = True
+        # Don't hold up other runs on the shared executor with work that is no
+        # longer needed
+        for future in self._offloaded:
+            future.cancel()
         await self._comm_buffer.close()
         await self._disk_buffer.close()
-        try:
-            self.executor.shutdown(cancel_futures=True)
-        except Exception:
-            self.executor.shutdown()
+        await self._memory_buffer.close()
         self._closed_event.set()
 
     def fail(self, exception: Exception) -> None:
@@ -338,6 +455,8 @@ class ShuffleWorkerExtension:
     _runs: set[ShuffleRun]
     memory_limiter_comms: ResourceLimiter
     memory_limiter_disk: ResourceLimiter
+    memory_limiter_output: ResourceLimiter
+    executor: ThreadPoolExecutor
     closed: bool
 
     def __init__(self, worker: Worker) -> None:
@@ -353,6 +472,17 @@ class ShuffleWorkerExtension:
         self._runs = set()
         self.memory_limiter_comms = ResourceLimiter(parse_bytes("100 MiB"))
         self.memory_limiter_disk = ResourceLimiter(parse_bytes("1 GiB"))
+        # Received output is kept in memory on top of the other buffers, only
+        # allow a small share of the memory the worker may use
+        output_limit = parse_bytes("1 GiB")
+        if worker.memory_manager.memory_limit:
+            output_limit = min(output_limit, worker.memory_manager.memory_limit // 10)
+        self.memory_limiter_output = ResourceLimiter(output_limit)
+        # Share one thread pool across all shuffles so that concurrent shuffles
+        # don't multiply the number of threads on the worker
+        self.executor = ThreadPoolExecutor(
+            worker.state.nthreads, thread_name_prefix="shuffle"
+        )
         self.closed = False
 
     # Handlers
@@ -366,7 +496,7 @@ class ShuffleWorkerExtension:
         self,
         shuffle_id: ShuffleId,
         run_id: int,
-        data: list[tuple[int, bytes]],
+        data: list[tuple[list[tuple[int, int]], memoryview]],
     ) -> None:
         """
         Handler: Receive an incoming shard of data from a peer worker.
@@ -576,6 +706,8 @@ class ShuffleWorkerExtension:
             column=result["column"],
             worker_for=result["worker_for"],
             output_workers=result["output_workers"],
+            # Don't offload this. Nothing may be awaited between the scheduler's
+            # reply and registering the run, see ``shuffle_fail``
             schema=deserialize_schema(result["schema"]),
             id=shuffle_id,
             run_id=result["run_id"],
@@ -583,12 +715,13 @@ class ShuffleWorkerExtension:
                 self.worker.local_directory,
                 f"shuffle-{shuffle_id}-{result['run_id']}",
             ),
-            nthreads=self.worker.state.nthreads,
+            executor=self.executor,
             local_address=self.worker.address,
             rpc=self.worker.rpc,
             scheduler=self.worker.scheduler,
             memory_limiter_disk=self.memory_limiter_disk,
             memory_limiter_comms=self.memory_limiter_comms,
+            memory_limiter_output=self.memory_limiter_output,
         )
         self.shuffles[shuffle_id] = shuffle
         self._runs.add(shuffle)
@@ -602,6 +735,10 @@ class ShuffleWorkerExtension:
             _, shuffle = self.shuffles.popitem()
             await shuffle.close()
             self._runs.remove(shuffle)
+        try:
+            self.executor.shutdown(cancel_futures=True)
+        except Exception:
+            self.executor.shutdown()
 
     #############################
     # Methods for worker thread #
@@ -655,47 +792,88 @@ def split_by_worker(
     df: pd.DataFrame,
     column: str,
     worker_for: pd.Series,
+    workers: np.ndarray,
+    lookup: np.ndarray | None = None,
 ) -> dict[Any, pa.Table]:
     """
     Split data into many arrow batches, partitioned by destination worker
+
+    ``workers`` are the categories of ``worker_for`` as a numpy array.
+    ``lookup`` may be passed if it has already been built from ``worker_for``
+    with ``_worker_codes_lookup``.
     """
     import numpy as np
     import pyarrow as pa
+    import pyarrow.compute as pc
 
-    df = df.merge(
-        right=worker_for.cat.codes.rename("_worker"),
-        left_on=column,
-        right_index=True,
-        how="inner",
-    )
-    nrows = len(df)
-    if not nrows:
+    # Look up the worker code of every row directly instead of merging with
+    # ``worker_for``. Rows of partitions that aren't wanted map to -1.
+    if lookup is None:
+        lookup = _worker_codes_lookup(worker_for)
+    if not len(lookup):
         return {}
-    # assert len(df) == nrows  # Not true if some outputs aren't wanted
+    values = df[column].to_numpy()
+    wanted = (values >= 0) & (values < len(lookup))
+    codes = np.full(len(values), -1, dtype=lookup.dtype)
+    codes[wanted] = lookup[values[wanted]]
     # FIXME: If we do not preserve the index something is corrupting the
     # bytestream such that it cannot be deserialized anymore
+    # NOTE: from_pandas does not copy numpy backed columns. Unwanted rows are
+    # sliced off after sorting so that the payload is only copied once.
     t = pa.Table.from_pandas(df, preserve_index=True)
-    t = t.sort_by("_worker")
-    codes = np.asarray(t.select(["_worker"]))[0]
-    t = t.drop(["_worker"])
-    del df
+    del df, values
+    # Sorting the codes on their own is cheaper than a general table sort
+    codes = pa.array(codes)
+    indices = pc.sort_indices(codes)
+    t = t.take(indices)
+    counts = pc.value_counts(codes.take(indices))
+    del codes, indices
+
+    unique_codes = counts.field("values").to_numpy()
+    lengths = counts.field("counts").to_numpy()
+    if len(unique_codes) and unique_codes[0] < 0:
+        t = t.slice(offset=lengths[0])
+        unique_codes = unique_codes[1:]
+        lengths = lengths[1:]
+    if not len(t):
+        return {}
+    shards = _split_sorted(t, lengths)
+    out = dict(zip(workers[unique_codes], shards))
+    # The lengths are the counts of the sorted codes, no rows are lost as long
+    # as every worker got its own shard
+    assert len(out) == len(shards)
+    return out
 
-    splits = np.where(codes[1:] != codes[:-1])[0] + 1
-    splits = np.concatenate([[0], splits])
 
-    shards = [
-        t.slice(offset=a, length=b - a) for a, b in toolz.sliding_window(2, splits)
-    ]
-    shards.append(t.slice(offset=splits[-1], length=None))
-
-    unique_codes = codes[splits]
-    out = {
-        # FIXME https://github.com/pandas-dev/pandas-stubs/issues/43
-        worker_for.cat.categories[code]: shard
-        for code, shard in zip(unique_codes, shards)
-    }
-    assert sum(map(len, out.values())) == nrows
-    return out
+def _worker_codes_lookup(worker_for: pd.Series) -> np.ndarray:
+    """
+    Build an array mapping output partitions to worker codes
+
+    Partitions that don't appear in ``worker_for`` map to -1.
+    """
+    import numpy as np
+
+    # NOTE: This may run in threads. Don't use the index of ``worker_for`` for
+    # lookups since lazily building its engine isn't thread-safe.
+    partitions = worker_for.index.to_numpy()
+    if not len(partitions):
+        return np.empty(0, dtype=worker_for.cat.codes.dtype)
+    lookup = np.full(partitions.max() + 1, -1, dtype=worker_for.cat.codes.dtype)
+    lookup[partitions] = worker_for.cat.codes.to_numpy()
+    return lookup
+
+
+def _drop_rows(t: pa.Table, ranges: list[tuple[int, int]]) -> pa.Table:
+    """
+    Drop the given ``(offset, length)`` row ranges from a table
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    mask = np.ones(len(t), dtype=bool)
+    for offset, length in ranges:
+        mask[offset : offset + length] = False
+    return t.filter(pa.array(mask))
 
 
 def split_by_partition(t: pa.Table, column: str) -> dict[Any, pa.Table]:
@@ -703,19 +881,40 @@ def split_by_partition(t: pa.Table, column: str) -> dict[Any, pa.Table]:
     Split data into many arrow batches, partitioned by final partition
     """
     import numpy as np
+    import pyarrow.compute as pc
+
+    counts = pc.value_counts(t.column(column))
+    partitions = counts.field("values").to_numpy()
+    if len(partitions) == 1:
+        # Everything belongs to the same partition, no need to sort
+        return {partitions[0]: t}
+    # Groups are counted in order of appearance, bring them in the order of
+    # the sorted table instead of counting a second time
+    order = np.argsort(partitions, kind="stable")
+    partitions = partitions[order]
+    t = t.take(pc.sort_indices(t.column(column)))
+    shards = _split_sorted(t, counts.field("counts").to_numpy()[order])
+    assert len(partitions) == len(shards)
+    return dict(zip(partitions, shards))
+
+
+def _serialize_partitions(
+    data: dict[str, list[pa.Table]]
+) -> dict[str, list[bytearray]]:
+    """
+    Serialize the tables of every partition into a single arrow stream
+    """
+    return {k: [serialize_tables(tables)] for k, tables in data.items()}
 
-    partitions = t.select([column]).to_pandas()[column].unique()
-    partitions.sort()
-    t = t.sort_by(column)
 
-    partition = np.asarray(t.select([column]))[0]
-    splits = np.where(partition[1:] != partition[:-1])[0] + 1
-    splits = np.concatenate([[0], splits])
+def _split_sorted(t: pa.Table, lengths: np.ndarray) -> list[pa.Table]:
+    """
+    Slice a sorted table into consecutive groups of the given lengths
+    """
+    import numpy as np
 
-    shards = [
-        t.slice(offset=a, length=b - a) for a, b in toolz.sliding_window(2, splits)
+    offsets = np.cumsum(lengths) - lengths
+    return [
+        t.slice(offset=offset, length=length)
+        for offset, length in zip(offsets.tolist(), lengths.tolist())
     ]
-    shards.append(t.slice(offset=splits[-1], length=None))
-    assert len(t) == sum(map(len, shards))
-    assert len(partitions) == len(shards)
-    return dict(zip(partitions, shards))
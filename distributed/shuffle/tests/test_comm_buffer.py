@@ -134,3 +134,37 @@ async def test_concurrent_puts_error():
 
     assert not mc.shards
     assert not mc.sizes
+
+
+@gen_test()
+async def test_batch_small_messages():
+    sends = []
+
+    async def send(address, shards):
+        sends.append((address, len(shards)))
+
+    mc = CommShardsBuffer(send=send)
+    for _ in range(20):
+        await mc.write({"x": [b"0" * 1000], "y": [b"1" * 1000]})
+        await asyncio.sleep(0)
+    assert not sends
+
+    await mc.flush()
+    assert sorted(sends) == [("x", 20), ("y", 20)]
+    await mc.close()
+
+
+@gen_test()
+async def test_max_linger():
+    d = defaultdict(list)
+
+    async def send(address, shards):
+        d[address].extend(shards)
+
+    mc = CommShardsBuffer(send=send)
+    mc.max_linger = 0.1
+    await mc.write({i: [b"0" * 1000] for i in range(10)})
+    while len(d) < 10:
+        await asyncio.sleep(0.01)
+    assert all(len(shards) == 1 for shards in d.values())
+    await mc.close()
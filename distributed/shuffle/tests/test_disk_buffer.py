@@ -5,6 +5,7 @@ import os
 
 import pytest
 
+from distributed.metrics import time
 from distributed.shuffle._disk import DiskShardsBuffer
 from distributed.utils_test import gen_test
 
@@ -127,3 +128,49 @@ async def test_high_pressure_flush_with_exception(tmp_path):
         with pytest.raises(Exception, match="123"):
             await mf.flush()
             mf.raise_on_exception()
+
+
+@gen_test()
+async def test_min_message_size(tmp_path):
+    writes = []
+
+    def dump_counting(data, f):
+        writes.append(len(data))
+        dump(data, f)
+
+    async with DiskShardsBuffer(
+        directory=tmp_path, dump=dump_counting, load=load, min_message_size=1000
+    ) as mf:
+        for _ in range(3):
+            await mf.write({"x": [b"0" * 100], "y": [b"1" * 300]})
+        await asyncio.sleep(0.01)
+        assert not writes
+
+        await mf.write({"x": [b"0" * 100], "y": [b"1" * 300]})
+        while not writes:
+            await asyncio.sleep(0)
+        # Only y has accumulated enough to be written
+        assert writes == [4]
+        assert mf.sizes == {"x": 400}
+
+        await mf.flush()
+        assert writes == [4, 4]
+        assert mf.read("x") == b"0" * 400
+        assert mf.read("y") == b"1" * 1200
+
+
+@gen_test()
+async def test_max_linger(tmp_path):
+    async with DiskShardsBuffer(
+        directory=tmp_path, dump=dump, load=load, min_message_size=1000
+    ) as mf:
+        mf.max_linger = 0.2
+        start = time()
+        await mf.write({i: [str(i).encode() * 100] for i in range(10)})
+        await asyncio.sleep(0.01)
+        assert mf.shards
+        while mf.shards:
+            await asyncio.sleep(0.01)
+        # All buckets expire together instead of one per max_linger
+        assert time() - start < 1
+        assert mf.bytes_written == 1000
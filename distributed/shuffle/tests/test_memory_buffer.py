@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+from distributed.shuffle._limiter import ResourceLimiter
+from distributed.shuffle._memory import MemoryShardsBuffer
+from distributed.utils_test import gen_test
+
+
+@gen_test()
+async def test_basic():
+    limiter = ResourceLimiter(10_000)
+    mb = MemoryShardsBuffer(memory_limiter=limiter, sizeof=len)
+    assert await mb.write({"x": [b"0" * 1000], "y": [b"1" * 500]}) == {}
+    assert await mb.write({"x": [b"0" * 1000], "y": [b"1" * 500]}) == {}
+    assert mb.bytes_memory == 3000
+    assert not limiter.free()
+
+    assert mb.read("x") == [b"0" * 1000] * 2
+    assert mb.read("y") == [b"1" * 500] * 2
+    assert mb.read("z") == []
+    assert mb.bytes_read == 3000
+
+    await mb.close()
+    assert mb.bytes_memory == 0
+    assert limiter.free()
+
+
+@gen_test()
+async def test_read_twice():
+    limiter = ResourceLimiter(10_000)
+    mb = MemoryShardsBuffer(memory_limiter=limiter, sizeof=len)
+    await mb.write({"x": [b"0" * 1000]})
+
+    assert mb.read("x") == [b"0" * 1000]
+    assert mb.read("x") == [b"0" * 1000]
+    # Data is held until the buffer is closed
+    assert mb.bytes_memory == 1000
+    assert not limiter.free()
+
+    await mb.close()
+    assert mb.read("x") == []
+    assert limiter.free()
+
+
+@gen_test()
+async def test_spill_oldest_first():
+    limiter = ResourceLimiter(2_000)
+    mb = MemoryShardsBuffer(memory_limiter=limiter, sizeof=len)
+    assert await mb.write({"x": [b"0" * 1000]}) == {}
+    assert await mb.write({"y": [b"1" * 500]}) == {}
+    # More data for x doesn't make it any younger
+    assert await mb.write({"z": [b"2" * 500], "x": [b"0" * 100]}) == {
+        "x": [b"0" * 1000, b"0" * 100]
+    }
+    assert mb.bytes_spilled == 1100
+    assert mb.bytes_memory == 1000
+
+    assert mb.read("x") == []
+    assert mb.read("y") == [b"1" * 500]
+    await mb.close()
+    assert mb.bytes_memory == 0
+    assert limiter.free()
+
+
+@gen_test()
+async def test_spill_everything():
+    limiter = ResourceLimiter(0)
+    mb = MemoryShardsBuffer(memory_limiter=limiter, sizeof=len)
+    assert await mb.write({1: [b"0"], 2: [b"1"]}) == {"1": [b"0"], "2": [b"1"]}
+    assert mb.bytes_memory == 0
+    assert limiter.free()
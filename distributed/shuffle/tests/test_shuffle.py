@@ -6,7 +6,9 @@ import itertools
 import os
 import random
 import shutil
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import count
 from typing import Any, Mapping
 from unittest import mock
@@ -23,7 +25,7 @@ from dask.utils import stringify
 from distributed.core import PooledRPCCall
 from distributed.scheduler import Scheduler
 from distributed.scheduler import TaskState as SchedulerTaskState
-from distributed.shuffle._arrow import serialize_table
+from distributed.shuffle._arrow import serialize_table, serialize_tables
 from distributed.shuffle._limiter import ResourceLimiter
 from distributed.shuffle._scheduler_extension import get_worker_for
 from distributed.shuffle._shuffle import ShuffleId, barrier_key
@@ -129,13 +131,17 @@ async def test_concurrent(c, s, a, b):
     await clean_scheduler(s)
 
 
+@mock.patch.object(ShuffleRun, "min_disk_write_size", 0)
 @gen_cluster(client=True)
 async def test_bad_disk(c, s, a, b):
+    # Don't keep anything in memory so that all data goes to disk right away
+    for w in [a, b]:
+        w.extensions["shuffle"].memory_limiter_output = ResourceLimiter(0)
     df = dask.datasets.timeseries(
         start="2000-01-01",
         end="2000-01-10",
         dtypes={"x": float, "y": float},
-        freq="10 s",
+        freq="1 s",
     )
     out = dd.shuffle.shuffle(df, "x", shuffle="p2p")
     out = out.persist()
@@ -664,7 +670,12 @@ def test_processing_chain():
     worker_for = {i: random.choice(workers) for i in list(range(npartitions))}
     worker_for = pd.Series(worker_for, name="_worker").astype("category")
 
-    data = split_by_worker(df, "_partitions", worker_for=worker_for)
+    data = split_by_worker(
+        df,
+        "_partitions",
+        worker_for=worker_for,
+        workers=worker_for.cat.categories.to_numpy(),
+    )
     assert set(data) == set(worker_for.cat.categories)
     assert sum(map(len, data.values())) == len(df)
 
@@ -722,6 +733,20 @@ def test_processing_chain():
     )
 
 
+def test_convert_partition_does_not_copy():
+    pa = pytest.importorskip("pyarrow")
+
+    tables = [pa.table({"x": range(10)}), pa.table({"x": range(10, 20)})]
+    data = b"".join(serialize_table(t) for t in tables)
+    out = convert_partition(data)
+    assert out.column("x").to_pylist() == list(range(20))
+
+    buffer = pa.py_buffer(data)
+    for chunk in out.column("x").chunks:
+        address = chunk.buffers()[1].address
+        assert buffer.address <= address < buffer.address + buffer.size
+
+
 @gen_cluster(client=True)
 async def test_head(c, s, a, b):
     a_files = list(os.walk(a.local_directory))
@@ -746,6 +771,8 @@ async def test_head(c, s, a, b):
 
 
 def test_split_by_worker():
+    pytest.importorskip("pyarrow")
+
     workers = ["a", "b", "c"]
     npartitions = 5
     df = pd.DataFrame({"x": range(100), "y": range(100)})
@@ -753,6 +780,25 @@ def test_split_by_worker():
     worker_for = {i: random.choice(workers) for i in range(npartitions)}
     s = pd.Series(worker_for, name="_worker").astype("category")
 
+    out = split_by_worker(df, "_partitions", s, s.cat.categories.to_numpy())
+    assert set(out) == set(s.cat.categories)
+    assert sum(map(len, out.values())) == len(df)
+    for worker, t in out.items():
+        partitions = t.column("_partitions").to_pylist()
+        assert all(worker_for[p] == worker for p in partitions)
+
+
+def test_split_by_worker_drops_unwanted_partitions():
+    pytest.importorskip("pyarrow")
+
+    df = pd.DataFrame({"x": range(10), "_partitions": [0, 1, 2, 3, 4] * 2})
+    s = pd.Series({0: "a", 2: "b", 4: "a"}, name="_worker").astype("category")
+
+    out = split_by_worker(df, "_partitions", s, s.cat.categories.to_numpy())
+    assert set(out) == {"a", "b"}
+    assert sorted(out["a"].column("x").to_pylist()) == [0, 4, 5, 9]
+    assert sorted(out["b"].column("x").to_pylist()) == [2, 7]
+
 
 @gen_cluster(client=True, nthreads=[("", 1)] * 2)
 async def test_clean_after_forgotten_early(c, s, a, b):
@@ -1089,20 +1135,22 @@ async def test_clean_after_close(c, s, a, b):
 
 
 class PooledRPCShuffle(PooledRPCCall):
-    def __init__(self, shuffle: ShuffleRun):
+    def __init__(self, shuffle: ShuffleRun, pool: ShuffleTestPool):
         self.shuffle = shuffle
+        self.pool = pool
 
     def __getattr__(self, key):
         async def _(**kwargs):
-            from distributed.protocol.serialize import nested_deserialize
+            from distributed.protocol import dumps, loads
 
             method_name = key.replace("shuffle_", "")
             kwargs.pop("shuffle_id", None)
             kwargs.pop("run_id", None)
-            # TODO: This is a bit awkward. At some point the arguments are
-            # already getting wrapped with a `Serialize`. We only want to unwrap
-            # here.
-            kwargs = nested_deserialize(kwargs)
+            # Round trip through the protocol to receive the arguments the
+            # same way a remote worker would
+            kwargs = loads(dumps(kwargs))
+            if method_name == "receive":
+                self.pool.bytes_sent += sum(len(buffer) for _, buffer in kwargs["data"])
             meth = getattr(self.shuffle, method_name)
             return await meth(**kwargs)
 
@@ -1114,10 +1162,12 @@ class ShuffleTestPool:
 
     def __init__(self, *args, **kwargs):
         self.shuffles = {}
+        self.bytes_sent = 0
+        self.executor = ThreadPoolExecutor(2)
         super().__init__(*args, **kwargs)
 
     def __call__(self, addr: str, *args: Any, **kwargs: Any) -> PooledRPCShuffle:
-        return PooledRPCShuffle(self.shuffles[addr])
+        return PooledRPCShuffle(self.shuffles[addr], self)
 
     async def shuffle_barrier(self, id, run_id):
         out = {}
@@ -1125,6 +1175,9 @@ class ShuffleTestPool:
             out[addr] = await s.inputs_done()
         return out
 
+    def close(self):
+        self.executor.shutdown()
+
     def new_shuffle(
         self, name, worker_for_mapping, schema, directory, loop, Shuffle=ShuffleRun
     ):
@@ -1138,11 +1191,12 @@ class ShuffleTestPool:
             id=ShuffleId(name),
             run_id=next(ShuffleTestPool._shuffle_run_id_iterator),
             local_address=name,
-            nthreads=2,
+            executor=self.executor,
             rpc=self,
             scheduler=self,
             memory_limiter_disk=ResourceLimiter(10000000),
             memory_limiter_comms=ResourceLimiter(10000000),
+            memory_limiter_output=ResourceLimiter(10000000),
         )
         self.shuffles[name] = s
         return s
@@ -1206,17 +1260,16 @@ async def test_basic_lowlevel_shuffle(
 
         await barrier_worker.barrier()
 
-        total_bytes_sent = 0
         total_bytes_recvd = 0
         total_bytes_recvd_shuffle = 0
         for s in shuffles:
             metrics = s.heartbeat()
             assert metrics["comm"]["total"] == metrics["comm"]["written"]
-            total_bytes_sent += metrics["comm"]["written"]
             total_bytes_recvd += metrics["disk"]["total"]
             total_bytes_recvd_shuffle += s.total_recvd
 
-        assert total_bytes_recvd_shuffle == total_bytes_sent
+        # The comm buffers hold Arrow tables, compare what went over the wire
+        assert total_bytes_recvd_shuffle == local_shuffle_pool.bytes_sent
 
         all_parts = []
         for part, worker in worker_for_mapping.items():
@@ -1228,9 +1281,147 @@ async def test_basic_lowlevel_shuffle(
         df_after = pd.concat(all_parts)
     finally:
         await asyncio.gather(*[s.close() for s in shuffles])
+        local_shuffle_pool.close()
     assert len(df_after) == len(pd.concat(dfs))
 
 
+@gen_test()
+async def test_receive_drops_duplicate_input_partitions(tmpdir, loop_in_thread):
+    pa = pytest.importorskip("pyarrow")
+
+    dfs = [
+        pd.DataFrame({"x": range(10 * ix, 10 * (ix + 1)), "_partition": 0})
+        for ix in range(3)
+    ]
+    tables = [pa.Table.from_pandas(df, preserve_index=True) for df in dfs]
+    schema = pa.Schema.from_pandas(dfs[0])
+
+    local_shuffle_pool = ShuffleTestPool()
+    s = local_shuffle_pool.new_shuffle(
+        name="A",
+        worker_for_mapping={0: "A"},
+        schema=schema,
+        directory=tmpdir,
+        loop=loop_in_thread,
+    )
+    try:
+        await s.receive([([(0, 10), (1, 10)], serialize_tables(tables[:2]))])
+        # Input partition 1 has already been received
+        await s.receive([([(1, 10), (2, 10)], serialize_tables(tables[1:]))])
+        # Nothing new
+        await s.receive([([(0, 10)], serialize_tables(tables[:1]))])
+        await s.inputs_done()
+        out = await s.get_output_partition(0)
+    finally:
+        await s.close()
+        local_shuffle_pool.close()
+    pd.testing.assert_frame_equal(out.sort_values("x"), pd.concat(dfs))
+
+
+@pytest.mark.parametrize("spill", [False, True])
+@gen_test()
+async def test_get_output_partition_twice(tmpdir, loop_in_thread, spill):
+    pa = pytest.importorskip("pyarrow")
+
+    df = pd.DataFrame({"x": range(10), "_partition": 0})
+    schema = pa.Schema.from_pandas(df)
+
+    local_shuffle_pool = ShuffleTestPool()
+    s = local_shuffle_pool.new_shuffle(
+        name="A",
+        worker_for_mapping={0: "A"},
+        schema=schema,
+        directory=tmpdir,
+        loop=loop_in_thread,
+    )
+    if spill:
+        s._memory_buffer.memory_limiter = ResourceLimiter(0)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        await s.receive([([(0, 10)], serialize_tables([table]))])
+        await s.inputs_done()
+        # e.g. the unpack task is recomputed
+        first = await s.get_output_partition(0)
+        second = await s.get_output_partition(0)
+    finally:
+        await s.close()
+        local_shuffle_pool.close()
+    pd.testing.assert_frame_equal(first, df)
+    pd.testing.assert_frame_equal(second, df)
+
+
+@gen_test()
+async def test_receive_spills_to_disk(tmpdir, loop_in_thread):
+    pa = pytest.importorskip("pyarrow")
+
+    dfs = [
+        pd.DataFrame({"x": range(10 * ix, 10 * (ix + 1)), "_partition": ix % 2})
+        for ix in range(4)
+    ]
+    tables = [pa.Table.from_pandas(df, preserve_index=True) for df in dfs]
+    schema = pa.Schema.from_pandas(dfs[0])
+
+    local_shuffle_pool = ShuffleTestPool()
+    s = local_shuffle_pool.new_shuffle(
+        name="A",
+        worker_for_mapping={0: "A", 1: "A"},
+        schema=schema,
+        directory=tmpdir,
+        loop=loop_in_thread,
+    )
+    # Don't keep anything in memory
+    s._memory_buffer.memory_limiter = ResourceLimiter(0)
+    try:
+        await s.receive([([(0, 10), (1, 10)], serialize_tables(tables[:2]))])
+        await s.receive([([(2, 10), (3, 10)], serialize_tables(tables[2:]))])
+        await s.inputs_done()
+        out = await asyncio.gather(s.get_output_partition(0), s.get_output_partition(1))
+        assert s._disk_buffer.bytes_written
+        assert not s._memory_buffer.bytes_read
+    finally:
+        await s.close()
+        local_shuffle_pool.close()
+    for i in range(2):
+        pd.testing.assert_frame_equal(
+            out[i].sort_values("x"), pd.concat(dfs[i::2]).sort_values("x")
+        )
+
+
+@gen_test()
+async def test_close_cancels_queued_offloads(tmpdir, loop_in_thread):
+    pa = pytest.importorskip("pyarrow")
+
+    schema = pa.Schema.from_pandas(pd.DataFrame({"x": [], "_partition": []}))
+    local_shuffle_pool = ShuffleTestPool()
+    s = local_shuffle_pool.new_shuffle(
+        name="A",
+        worker_for_mapping={0: "A"},
+        schema=schema,
+        directory=tmpdir,
+        loop=loop_in_thread,
+    )
+    # Occupy every thread of the shared executor
+    block = threading.Event()
+    blockers = [
+        local_shuffle_pool.executor.submit(block.wait)
+        for _ in range(local_shuffle_pool.executor._max_workers)
+    ]
+    ran = []
+    try:
+        task = asyncio.create_task(s.offload(ran.append, 1))
+        while not s._offloaded:
+            await asyncio.sleep(0.01)
+        await s.close()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(task, timeout=5)
+    finally:
+        block.set()
+        for future in blockers:
+            future.result()
+        local_shuffle_pool.close()
+    assert not ran
+
+
 @gen_test()
 async def test_error_offload(tmpdir, loop_in_thread):
     pa = pytest.importorskip("pyarrow")
@@ -1282,6 +1473,7 @@ async def test_error_offload(tmpdir, loop_in_thread):
             await sB.barrier()
     finally:
         await asyncio.gather(*[s.close() for s in [sA, sB]])
+        local_shuffle_pool.close()
 
 
 @gen_test()
@@ -1334,6 +1526,7 @@ async def test_error_send(tmpdir, loop_in_thread):
             await sA.barrier()
     finally:
         await asyncio.gather(*[s.close() for s in [sA, sB]])
+        local_shuffle_pool.close()
 
 
 @gen_test()
@@ -1386,6 +1579,7 @@ async def test_error_receive(tmpdir, loop_in_thread):
             await sB.barrier()
     finally:
         await asyncio.gather(*[s.close() for s in [sA, sB]])
+        local_shuffle_pool.close()
 
 
 from distributed.worker import DEFAULT_EXTENSIONS
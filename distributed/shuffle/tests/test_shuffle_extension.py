@@ -31,6 +31,12 @@ async def test_installation_on_worker(s, a):
     assert not iscoroutinefunction(ext.shuffle_fail)
 
 
+@gen_cluster([("", 1)], worker_kwargs={"memory_limit": "1 GiB"})
+async def test_output_memory_bounded_by_worker_memory_limit(s, a):
+    ext = a.extensions["shuffle"]
+    assert ext.memory_limiter_output._maxvalue == a.memory_manager.memory_limit // 10
+
+
 @gen_cluster([("", 1)])
 async def test_installation_on_scheduler(s, a):
     ext = s.extensions["shuffle"]
@@ -55,7 +61,9 @@ def test_split_by_worker():
     for part in range(npartitions):
         worker_for_mapping[part] = get_worker_for(part, workers, npartitions)
     worker_for = pd.Series(worker_for_mapping, name="_workers").astype("category")
-    out = split_by_worker(df, "_partition", worker_for)
+    out = split_by_worker(
+        df, "_partition", worker_for, worker_for.cat.categories.to_numpy()
+    )
     assert set(out) == {"alice", "bob"}
     assert list(out["alice"].to_pandas().columns) == list(df.columns)
 
@@ -72,7 +80,9 @@ def test_split_by_worker_empty():
         }
     )
     worker_for = pd.Series({5: "chuck"}, name="_workers").astype("category")
-    out = split_by_worker(df, "_partition", worker_for)
+    out = split_by_worker(
+        df, "_partition", worker_for, worker_for.cat.categories.to_numpy()
+    )
     assert out == {}
 
 
@@ -91,7 +101,9 @@ def test_split_by_worker_many_workers():
     for part in range(npartitions):
         worker_for_mapping[part] = get_worker_for(part, workers, npartitions)
     worker_for = pd.Series(worker_for_mapping, name="_workers").astype("category")
-    out = split_by_worker(df, "_partition", worker_for)
+    out = split_by_worker(
+        df, "_partition", worker_for, worker_for.cat.categories.to_numpy()
+    )
     assert get_worker_for(5, workers, npartitions) in out
     assert get_worker_for(0, workers, npartitions) in out
     assert get_worker_for(7, workers, npartitions) in out
@@ -115,3 +127,16 @@ def test_split_by_partition():
     assert set(out) == {1, 2, 3}
     assert out[1].column_names == list(df.columns)
     assert sum(map(len, out.values())) == len(df)
+    for part, shard in out.items():
+        assert shard.column("_partition").to_pylist() == [part] * len(shard)
+
+
+def test_split_by_partition_single_partition():
+    pa = pytest.importorskip("pyarrow")
+
+    df = pd.DataFrame({"x": [1, 2, 3], "_partition": [2, 2, 2]})
+    t = pa.Table.from_pandas(df)
+
+    out = split_by_partition(t, "_partition")
+    assert list(out) == [2]
+    assert out[2] is t